@@ -5,6 +5,8 @@
 
 echo "Adding deleted hack DB table"
 python3 -c "from ota_api.deleted_hack import migrate; migrate()"
+echo "Adding image report cache DB tables"
+python3 -c "from ota_api.report_db import migrate; migrate()"
 
 if [ -z "$FLASK_DEBUG" ] ; then
 	exec /usr/bin/gunicorn -n ota-api -w4 -b 0.0.0.0:8000 $FLASK_APP:app
@@ -6,6 +6,8 @@ from flask import Blueprint
 
 def register_blueprints(app):
     from ota_api.api.device import blueprint as device_blueprint  # NOQA
+    from ota_api.api.report import blueprint as report_blueprint  # NOQA
+    from ota_api.api.status import blueprint as status_blueprint  # NOQA
     for obj in locals().values():
         if isinstance(obj, Blueprint):
             app.register_blueprint(obj)
@@ -0,0 +1,19 @@
+# Copyright (C) 2019 Foundries.io
+from flask import (
+    Blueprint, abort, current_app, jsonify, make_response, request
+)
+
+blueprint = Blueprint('reports', __name__, url_prefix='/reports')
+
+
+@blueprint.route('/images/')
+def images():
+    max_age = request.args.get('max-age')
+    if max_age is not None:
+        try:
+            max_age = int(max_age)
+        except ValueError:
+            message = 'Invalid max-age: %s' % max_age
+            abort(make_response(jsonify(message=message), 400))
+    user = current_app.OTAUser()
+    return jsonify(user.device_image_report(max_age))
@@ -0,0 +1,12 @@
+# Copyright (C) 2019 Foundries.io
+from flask import Blueprint, current_app, jsonify
+
+from ota_api.ota_ce import upstream_stats
+
+blueprint = Blueprint('status', __name__, url_prefix='/status')
+
+
+@blueprint.route('/upstreams/')
+def upstreams():
+    current_app.OTAUser()
+    return jsonify(upstream_stats())
@@ -6,6 +6,8 @@ from flask import Flask
 
 from werkzeug.contrib.fixers import ProxyFix
 
+from ota_api.ota_ce import request_deadline_start
+
 
 def create_app(settings_object='ota_api.settings'):
     app = Flask(__name__)
@@ -16,6 +18,8 @@ def create_app(settings_object='ota_api.settings'):
     module = import_module(module)
     app.OTAUser = getattr(module, clazz)
 
+    app.before_request(request_deadline_start)
+
     import ota_api.api
     ota_api.api.register_blueprints(app)
 
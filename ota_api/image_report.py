@@ -0,0 +1,116 @@
+# Copyright (C) 2019 Foundries.io
+import json
+import time
+
+from ota_api import report_db
+from ota_api.settings import (
+    REPORT_CONCURRENCY, REPORT_MAX_AGE, REQUEST_DEADLINE
+)
+
+
+def _fingerprint(device):
+    # A device can only change its image by reporting in to the server, so
+    # its cached image is still valid as long as these haven't changed.
+    return json.dumps([device['deviceStatus'], device.get('lastSeen')])
+
+
+def _latest_targets(targets):
+    '''Return a dictionary of hardware id -> newest target for it.'''
+    latest = {}
+    for name, target in targets.items():
+        for hwid in target['custom']['hardwareIds']:
+            cur = latest.get(hwid)
+            updated = target['custom']['updatedAt']
+            if not cur or cur[1]['custom']['updatedAt'] < updated:
+                latest[hwid] = (name, target)
+    return latest
+
+
+def _histogram(devices, images, targets):
+    by_hash = {}
+    for name, target in targets.items():
+        for hwid in target['custom']['hardwareIds']:
+            by_hash[(target['hashes']['sha256'], hwid)] = name
+    latest = _latest_targets(targets)
+
+    not_seen = 0
+    hwids = {}
+    for d in devices:
+        image = images.get(d['uuid'])
+        if not image:
+            not_seen += 1
+            continue
+        hwid = image['hardwareId']
+        entry = hwids.get(hwid)
+        if entry is None:
+            entry = {
+                'devices': 0,
+                'outdated': 0,
+                'unknown': 0,
+                'latest': latest.get(hwid, (None,))[0],
+                'targets': {},
+            }
+            hwids[hwid] = entry
+        entry['devices'] += 1
+
+        name = by_hash.get((image['image']['hash']['sha256'], hwid))
+        if name:
+            entry['targets'][name] = entry['targets'].get(name, 0) + 1
+        else:
+            # The image isn't in targets.json, eg it was built locally
+            entry['unknown'] += 1
+        if name != entry['latest']:
+            entry['outdated'] += 1
+
+    return {
+        'devices': len(devices),
+        'not-seen': not_seen,
+        'hardware-ids': hwids,
+    }
+
+
+def image_report(api, cache_key, devices, max_age=None):
+    '''Return a histogram of the targets devices are running, grouped by
+       hardware id. `devices` is called to list the devices to include and
+       the result is cached under `cache_key` for up to REPORT_MAX_AGE
+       seconds. When it expires only the devices that have reported in since
+       the last run have their images looked up again. The cache is kept in
+       the database so that it's shared by every gunicorn worker.
+    '''
+    if max_age is None or max_age > REPORT_MAX_AGE:
+        max_age = REPORT_MAX_AGE
+
+    with report_db.report_lock(cache_key, int(REQUEST_DEADLINE)):
+        now = time.time()
+        cached = report_db.report_get(cache_key)
+        if cached and now - cached[0] <= max_age:
+            return cached[1]
+
+        devices = list(devices())
+        fingerprints = {d['uuid']: _fingerprint(d) for d in devices}
+        images = report_db.images_get(cache_key)
+        stale = []
+        for d in devices:
+            cached = images.get(d['uuid'])
+            if not cached or cached[0] != fingerprints[d['uuid']]:
+                stale.append(d)
+
+        # Images are saved even if a lookup fails part way through so that
+        # the next run doesn't have to look them up again.
+        fetched = {}
+        try:
+            for uuid, image in api.device_images(stale, REPORT_CONCURRENCY):
+                fetched[uuid] = (fingerprints[uuid], image)
+        finally:
+            report_db.images_save(cache_key, fetched)
+        images.update(fetched)
+
+        # Drop devices that no longer exist
+        report_db.images_prune(cache_key, set(images) - set(fingerprints))
+        images = {u: images[u][1] for u in fingerprints}
+
+        report = _histogram(devices, images, api.tuf_targets())
+        report['created'] = int(now)
+        report['refreshed'] = len(stale)
+        report_db.report_save(cache_key, now, report)
+        return report
@@ -2,21 +2,203 @@
 # Author: Andy Doan <andy@foundries.io>
 import os
 import functools
+import re
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+)
 
 import requests
 
-from flask import abort, make_response, jsonify
+from flask import (
+    abort, copy_current_request_context, has_request_context, jsonify,
+    make_response, request
+)
 from werkzeug.exceptions import HTTPException
 
+from ota_api.settings import (
+    BREAKER_FAILURES, BREAKER_RESET, HEDGE_PERCENTILE, REQUEST_DEADLINE,
+    UPSTREAM_RETRIES, UPSTREAM_TIMEOUT, UPSTREAM_WORKERS
+)
+
 DIRECTOR_URL = os.environ.get('DIRECTOR_URL', 'http://director')
 REGISTRY_URL = os.environ.get('REGISTRY_URL', 'http://device-registry')
 REPO_URL = os.environ.get('REPO_URL', 'http://tuf-reposerver')
 
+_DEADLINE_KEY = 'ota_api.deadline'
+
+# Path segments like device uuids and ecu serials, but not "v1"
+_ID_SEGMENT = re.compile(r'^(?!v\d+$).*\d')
+
+# Hedged GETs are sent from here so the caller can wait on several of them
+_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS)
+
+_upstreams_lock = threading.Lock()
+_upstreams = {}
+
+
+class _DeadlineExceeded(requests.Timeout):
+    """A call that ran out of the request's deadline rather than its own
+       UPSTREAM_TIMEOUT.
+    """
+
+
+def request_deadline_start():
+    """Start the clock on how long the current flask request may spend
+       calling the OTA services. The deadline is kept in the WSGI environ so
+       that copies of the request context in worker threads share it.
+    """
+    request.environ[_DEADLINE_KEY] = time.monotonic() + REQUEST_DEADLINE
+
+
+def _deadline():
+    if has_request_context():
+        deadline = request.environ.get(_DEADLINE_KEY)
+        if deadline:
+            return deadline
+    return time.monotonic() + REQUEST_DEADLINE
+
+
+def _latency_key(method, resource, params):
+    """Return what a call's latency is tracked under, so that eg a page of
+       100 devices isn't hedged based on how fast single devices come back.
+    """
+    path = '/'.join('{}' if _ID_SEGMENT.match(x) else x
+                    for x in resource.split('/'))
+    key = method.__name__.upper() + ' ' + path
+    if params:
+        key += '?' + '&'.join(
+            sorted(k for k, v in params.items() if v is not None))
+    return key
+
+
+class _Upstream(object):
+    """Tracks the health of an OTA service so that calls to it can be hedged
+       and can fail fast with a circuit breaker while it is unhealthy.
+    """
+    LATENCY_SAMPLES = 200
+    MIN_SAMPLES = 20
+    MAX_LATENCY_KEYS = 100
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._lock = threading.Lock()
+        self._latencies = {}  # latency key -> recent latencies
+        self._failures = 0
+        self._opened = None
+        self._trial = None
+        self.counts = {
+            'requests': 0, 'failures': 0, 'rejected': 0,
+            'hedges': 0, 'retries': 0,
+        }
+
+    def _state(self):
+        if self._opened is None:
+            return 'closed'
+        if time.monotonic() - self._opened < BREAKER_RESET:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Return True if a call may be sent to this service."""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            now = time.monotonic()
+            trial = self._trial
+            if state == 'half-open' and (
+                    trial is None or now - trial > BREAKER_RESET):
+                # Let a single trial call through to see if it has recovered.
+                # A trial that never completed (eg it was cancelled) is given
+                # up on after BREAKER_RESET seconds.
+                self._trial = now
+                return True
+            self.counts['rejected'] += 1
+            return False
+
+    def success(self, key, latency):
+        with self._lock:
+            self.counts['requests'] += 1
+            latencies = self._latencies.get(key)
+            if latencies is None and \
+                    len(self._latencies) < self.MAX_LATENCY_KEYS:
+                latencies = deque(maxlen=self.LATENCY_SAMPLES)
+                self._latencies[key] = latencies
+            if latencies is not None:
+                latencies.append(latency)
+            self._failures = 0
+            self._opened = None
+            self._trial = None
+
+    def failure(self):
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts['failures'] += 1
+            self._failures += 1
+            if self._trial is not None or self._failures >= BREAKER_FAILURES:
+                self._opened = time.monotonic()
+            self._trial = None
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def hedge_delay(self, key):
+        """Return how long to wait on a GET before hedging it, or None if
+           there isn't enough history to know what "slow" is.
+        """
+        with self._lock:
+            latencies = self._latencies.get(key, ())
+            if not HEDGE_PERCENTILE or len(latencies) < self.MIN_SAMPLES:
+                return None
+            latencies = sorted(latencies)
+        idx = (len(latencies) - 1) * HEDGE_PERCENTILE // 100
+        return latencies[idx]
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._latencies)
+        delays = {k: self.hedge_delay(k) for k in keys}
+        with self._lock:
+            stats = dict(self.counts)
+            stats['url'] = self.base_url
+            stats['breaker'] = self._state()
+            stats['consecutive-failures'] = self._failures
+            stats['hedge-delays'] = delays
+            return stats
+
+
+def _upstream(base_url):
+    with _upstreams_lock:
+        up = _upstreams.get(base_url)
+        if up is None:
+            up = _upstreams[base_url] = _Upstream(base_url)
+        return up
+
+
+def upstream_stats():
+    """Return the breaker state and call counts of each OTA service. These
+       are kept in memory, so they only cover this process.
+    """
+    with _upstreams_lock:
+        upstreams = list(_upstreams.values())
+    return {
+        'pid': os.getpid(),
+        'upstreams': [x.stats() for x in upstreams],
+    }
+
 
 class _Server(object):
+    DEADLINE_MESSAGE = 'Request deadline exceeded'
+
     def __init__(self, namespace, base_url):
         self._base = base_url
         self._namespace = namespace
+        self._upstream = _upstream(base_url)
         self.get = functools.partial(self.request, requests.get)
         self.post = functools.partial(self.request, requests.post)
         self.put = functools.partial(self.request, requests.put)
@@ -32,16 +214,137 @@ class _Server(object):
         if method.__name__ == 'post':
             expected = 201
         expected = kwargs.pop('expected', expected)
-        resp = method(self._base + resource, *args, **kwargs)
+
+        url = self._base + resource
+        deadline = _deadline()
+        budget = kwargs.pop('timeout', None) or UPSTREAM_TIMEOUT
+        key = _latency_key(method, resource, kwargs.get('params'))
+        call = (method, url, deadline, budget, key, args, kwargs)
+        if time.monotonic() >= deadline:
+            self._abort(url, 504, self.DEADLINE_MESSAGE)
+        if not self._upstream.allow():
+            self._abort(url, 503, 'Service is unavailable (circuit open)')
+
+        if method.__name__ == 'get':
+            resp = self._send_hedged(call)
+        else:
+            resp = self._send_bounded(call)
+
         if resp.status_code != expected:
             try:
                 data = resp.json()
             except ValueError:
                 data = {'text': resp.text}
-            data['ota-source'] = self._base + resource
+            data['ota-source'] = url
             abort(make_response(jsonify(data), resp.status_code))
         return resp
 
+    def _abort(self, url, status, message):
+        data = {'message': message, 'ota-source': url}
+        abort(make_response(jsonify(data), status))
+
+    def _abort_failure(self, call, exception):
+        _, url, _, budget, _, _, _ = call
+        if isinstance(exception, _DeadlineExceeded):
+            self._abort(url, 504, self.DEADLINE_MESSAGE)
+        if isinstance(exception, requests.Timeout):
+            self._abort(url, 504, 'Upstream timed out after %gs' % budget)
+        self._abort(url, 502, str(exception))
+
+    def _send(self, call):
+        method, url, deadline, budget, key, args, kwargs = call
+        start = time.monotonic()
+        if start >= deadline:
+            # A hedge that sat queued until it was too late. This says
+            # nothing about the health of the service.
+            raise _DeadlineExceeded(self.DEADLINE_MESSAGE)
+        timeout = min(budget, deadline - start)
+        try:
+            resp = method(url, *args, timeout=timeout, **kwargs)
+        except requests.Timeout as e:
+            # Only count this against the service if it had its full budget
+            # rather than whatever was left of the request's deadline.
+            if timeout < budget:
+                raise _DeadlineExceeded(self.DEADLINE_MESSAGE) from e
+            self._upstream.failure()
+            raise
+        except Exception:
+            self._upstream.failure()
+            raise
+        if resp.status_code >= 500:
+            self._upstream.failure()
+        else:
+            self._upstream.success(key, time.monotonic() - start)
+        return resp
+
+    def _send_bounded(self, call):
+        """Send a call that isn't safe to retry. requests' timeout applies to
+           each socket operation rather than the whole call, so the call is
+           made in the executor and abandoned once the deadline passes.
+        """
+        _, url, deadline, _, _, _, _ = call
+        future = _executor.submit(self._send, call)
+        done, _ = wait([future], max(deadline - time.monotonic(), 0))
+        if not done:
+            future.cancel()
+            self._abort(url, 504, self.DEADLINE_MESSAGE)
+        try:
+            return future.result()
+        except requests.RequestException as e:
+            self._abort_failure(call, e)
+
+    def _send_hedged(self, call):
+        """GETs are idempotent, so when one fails or is slower than usual
+           another attempt is sent and the first good response wins.
+        """
+        _, url, deadline, _, key, _, _ = call
+        up = self._upstream
+        attempts = 1
+        launched = time.monotonic()
+        pending = {_executor.submit(self._send, call)}
+        failure = None
+        while pending:
+            now = time.monotonic()
+            timeout = deadline - now
+            delay = None
+            if attempts <= UPSTREAM_RETRIES:
+                delay = up.hedge_delay(key)
+            if delay is not None:
+                timeout = min(timeout, launched + delay - now)
+            done, pending = wait(
+                pending, max(timeout, 0), return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    resp = f.result()
+                except requests.RequestException as e:
+                    failure = e
+                    continue
+                if resp.status_code < 500:
+                    for p in pending:
+                        p.cancel()
+                    return resp
+                failure = resp
+
+            if time.monotonic() >= deadline:
+                break
+            if attempts > UPSTREAM_RETRIES or (done and pending):
+                continue
+            if not up.allow():
+                attempts = UPSTREAM_RETRIES + 1
+                continue
+            up.count('hedges' if pending else 'retries')
+            pending.add(_executor.submit(self._send, call))
+            attempts += 1
+            launched = time.monotonic()
+
+        for p in pending:
+            p.cancel()
+        if pending or failure is None:
+            self._abort(url, 504, self.DEADLINE_MESSAGE)
+        if isinstance(failure, requests.Response):
+            return failure
+        self._abort_failure(call, failure)
+
 
 class OTACommunityEditionAPI(object):
     def __init__(self, namespace):
@@ -76,6 +379,42 @@ class OTACommunityEditionAPI(object):
         r = self.director.get('/api/v1/admin/devices/' + device['uuid'])
         return r.json()[0]
 
+    def device_images(self, devices, concurrency=8):
+        """Look up the current image of each device with concurrent calls to
+           the director. Yields (device uuid, image) tuples as they arrive.
+           Devices that haven't been seen, or were deleted while this runs,
+           have an image of None.
+        """
+        def _image(device):
+            try:
+                return device['uuid'], self.device_image(device)
+            except IndexError:
+                return device['uuid'], None
+            except HTTPException as e:
+                if e.response.status_code != 404:
+                    raise
+                return device['uuid'], None
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = []
+        try:
+            for d in devices:
+                if d['deviceStatus'] == 'NotSeen':
+                    yield d['uuid'], None
+                else:
+                    # Each call needs its own copy of the request context so
+                    # errors can be turned into flask responses in workers.
+                    futures.append(executor.submit(
+                        copy_current_request_context(_image), d))
+            for f in as_completed(futures):
+                yield f.result()
+        finally:
+            # Don't wait on the remaining lookups if one of them failed.
+            # (shutdown's cancel_futures needs python 3.9)
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+
     def device_hardware(self, device):
         resource = '/api/v1/devices/' + device['uuid'] + '/system_info'
         try:
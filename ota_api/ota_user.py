@@ -5,6 +5,7 @@ import string
 from flask import abort, jsonify, make_response, request
 
 from ota_api.deleted_hack import device_is_deleted, device_mark_deleted
+from ota_api.image_report import image_report
 from ota_api.ota_ce import OTACommunityEditionAPI
 
 VALID_DEVICE_CHAR = set(string.ascii_letters + string.digits + '-' + '_' + '/')
@@ -33,6 +34,33 @@ class OTAUserBase(object):
             d['deviceImage'] = api.device_image(d)
             yield d
 
+    @property
+    def image_report_key(self):
+        """Return the key the image report for this user is cached under.
+           Users that can see different devices need different keys. The
+           report is disabled unless this is implemented, so that a
+           restricted device_list doesn't leak fleet-wide counts.
+        """
+        return None
+
+    def image_report_devices(self, api):
+        """This gives a developer the ability to provide restrictions on what
+           devices are counted in the image report.
+        """
+        return api.device_list()
+
+    def device_image_report(self, max_age=None):
+        """Return how many devices of each hardware id are running each
+           target.
+        """
+        key = self.image_report_key
+        if key is None:
+            message = 'Image reports are not enabled'
+            abort(make_response(jsonify(message=message), 403))
+        api = OTACommunityEditionAPI('default')
+        return image_report(
+            api, key, lambda: self.image_report_devices(api), max_age)
+
     def _get(self, name):
         api = OTACommunityEditionAPI('default')
         d = api.device_get(name)
@@ -137,3 +165,8 @@ class UnsafeUser(OTAUserBase):
     @property
     def max_devices(self):
         return 10
+
+    @property
+    def image_report_key(self):
+        # Every user can see every device
+        return 'default'
@@ -0,0 +1,100 @@
+# Copyright (C) 2019 Foundries.io
+import contextlib
+import json
+
+from ota_api.deleted_hack import db_cursor
+
+
+def migrate():
+    stmts = (
+        '''
+        CREATE TABLE IF NOT EXISTS OtaApiImageReport (
+            cache_key VARCHAR(64) NOT NULL,
+            created DOUBLE NOT NULL,
+            report MEDIUMTEXT NOT NULL,
+            PRIMARY KEY (cache_key)
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS OtaApiDeviceImage (
+            cache_key VARCHAR(64) NOT NULL,
+            uuid CHAR(36) NOT NULL,
+            fingerprint VARCHAR(255) NOT NULL,
+            image TEXT,
+            PRIMARY KEY (cache_key, uuid)
+        );
+        ''',
+    )
+    with db_cursor() as c:
+        for stmt in stmts:
+            c.execute(stmt)
+
+
+@contextlib.contextmanager
+def report_lock(cache_key, timeout):
+    '''Serialize report computations across all the gunicorn workers so the
+       director is only swept once. If the lock can't be taken in `timeout`
+       seconds the caller goes ahead without it.
+    '''
+    name = 'ota-api-report-' + cache_key
+    with db_cursor() as c:
+        c.execute('SELECT GET_LOCK(%s, %s)', (name, timeout))
+        try:
+            yield
+        finally:
+            c.execute('SELECT RELEASE_LOCK(%s)', name)
+
+
+def report_get(cache_key):
+    '''Return a tuple of (created, report) or None.'''
+    stmt = '''SELECT created, report
+              FROM OtaApiImageReport
+              WHERE cache_key = %s
+           '''
+    with db_cursor() as c:
+        c.execute(stmt, cache_key)
+        for created, report in c:
+            return created, json.loads(report)
+
+
+def report_save(cache_key, created, report):
+    stmt = '''REPLACE INTO OtaApiImageReport (cache_key, created, report)
+              VALUES (%s, %s, %s)
+           '''
+    with db_cursor(commit=True) as c:
+        c.execute(stmt, (cache_key, created, json.dumps(report)))
+
+
+def images_get(cache_key):
+    '''Return a dictionary of device uuid -> (fingerprint, image).'''
+    stmt = '''SELECT uuid, fingerprint, image
+              FROM OtaApiDeviceImage
+              WHERE cache_key = %s
+           '''
+    with db_cursor() as c:
+        c.execute(stmt, cache_key)
+        return {uuid: (fingerprint, json.loads(image))
+                for uuid, fingerprint, image in c}
+
+
+def images_save(cache_key, images):
+    '''Save a dictionary of device uuid -> (fingerprint, image).'''
+    if not images:
+        return
+    stmt = '''REPLACE INTO OtaApiDeviceImage
+                (cache_key, uuid, fingerprint, image)
+              VALUES (%s, %s, %s, %s)
+           '''
+    rows = [(cache_key, uuid, fingerprint, json.dumps(image))
+            for uuid, (fingerprint, image) in images.items()]
+    with db_cursor(commit=True) as c:
+        c.executemany(stmt, rows)
+
+
+def images_prune(cache_key, uuids):
+    '''Remove the cached images of devices that no longer exist.'''
+    if not uuids:
+        return
+    stmt = 'DELETE FROM OtaApiDeviceImage WHERE cache_key = %s AND uuid = %s'
+    with db_cursor(commit=True) as c:
+        c.executemany(stmt, [(cache_key, u) for u in uuids])
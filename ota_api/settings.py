@@ -6,3 +6,29 @@ import os
 USER_MODULE = os.environ.get('USER_MODULE', 'ota_api.ota_user:UnsafeUser')
 GATEWAY_SERVER = os.environ.get(
     'GATEWAY_SERVER', 'https://ota-ce.example.com:8443')
+
+# How long (in seconds) a computed fleet image report can be served from
+# cache before it is recomputed.
+REPORT_MAX_AGE = int(os.environ.get('REPORT_MAX_AGE', '300'))
+# Number of concurrent director calls used when collecting device images
+REPORT_CONCURRENCY = int(os.environ.get('REPORT_CONCURRENCY', '8'))
+
+# Total time (in seconds) a request to this API may spend calling the OTA
+# services. Each upstream call gets whatever is left of this budget.
+# This needs to be less than gunicorn's worker timeout (30s by default) so
+# that a hung service results in a 504 rather than a killed worker.
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '25'))
+# The most time (in seconds) a single call to an OTA service may take. Only
+# calls that time out after this long count against the circuit breaker.
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', '10'))
+# Extra attempts a GET may make. A new attempt is sent when one fails, or
+# is "hedged" when one takes longer than HEDGE_PERCENTILE of recent calls
+# to that service. A HEDGE_PERCENTILE of 0 disables hedging.
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '1'))
+HEDGE_PERCENTILE = int(os.environ.get('HEDGE_PERCENTILE', '95'))
+# Number of threads available for sending GETs to the OTA services
+UPSTREAM_WORKERS = int(os.environ.get('UPSTREAM_WORKERS', '32'))
+# Consecutive failures before calls to a service fail fast, and how many
+# seconds to wait before letting a trial call through again.
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.environ.get('BREAKER_RESET', '30'))
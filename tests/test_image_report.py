@@ -0,0 +1,206 @@
+# Copyright (C) 2019 Foundries.io
+import contextlib
+import copy
+import unittest
+from unittest import mock
+
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+from ota_api import image_report
+from ota_api.ota_ce import OTACommunityEditionAPI
+
+TARGETS = {
+    'rpi-1': {
+        'hashes': {'sha256': 'h1'},
+        'custom': {'hardwareIds': ['rpi'], 'updatedAt': '2019-01-01'},
+    },
+    'rpi-2': {
+        'hashes': {'sha256': 'h2'},
+        'custom': {'hardwareIds': ['rpi'], 'updatedAt': '2019-02-01'},
+    },
+    'imx-1': {
+        'hashes': {'sha256': 'h1'},
+        'custom': {'hardwareIds': ['imx'], 'updatedAt': '2019-03-01'},
+    },
+}
+
+
+def _device(uuid, last_seen='t0', status='UpToDate'):
+    return {'uuid': uuid, 'deviceStatus': status, 'lastSeen': last_seen}
+
+
+def _image(hwid, sha):
+    return {'hardwareId': hwid, 'image': {'hash': {'sha256': sha}}}
+
+
+class FakeAPI(object):
+    def __init__(self, images, fail=None):
+        self.images = images
+        self.fail = fail
+        self.looked_up = []
+
+    def device_images(self, devices, concurrency):
+        for d in devices:
+            if d['uuid'] == self.fail:
+                raise RuntimeError('lookup failed')
+            self.looked_up.append(d['uuid'])
+            yield d['uuid'], self.images.get(d['uuid'])
+
+    def tuf_targets(self):
+        return TARGETS
+
+
+class FakeReportDB(object):
+    """An in-memory stand-in for ota_api.report_db."""
+    def __init__(self):
+        self.reports = {}
+        self.images = {}
+        self.locked = []
+
+    @contextlib.contextmanager
+    def report_lock(self, cache_key, timeout):
+        self.locked.append(cache_key)
+        yield
+
+    def report_get(self, cache_key):
+        return copy.deepcopy(self.reports.get(cache_key))
+
+    def report_save(self, cache_key, created, report):
+        self.reports[cache_key] = (created, copy.deepcopy(report))
+
+    def images_get(self, cache_key):
+        return copy.deepcopy(self.images.get(cache_key, {}))
+
+    def images_save(self, cache_key, images):
+        self.images.setdefault(cache_key, {}).update(copy.deepcopy(images))
+
+    def images_prune(self, cache_key, uuids):
+        for u in uuids:
+            del self.images[cache_key][u]
+
+
+class TestHistogram(unittest.TestCase):
+    def test_histogram(self):
+        devices = [_device(x) for x in 'abcde']
+        images = {
+            'a': _image('rpi', 'h1'),
+            'b': _image('rpi', 'h2'),
+            'c': _image('rpi', 'unknown'),
+            'd': _image('imx', 'h1'),
+        }
+        report = image_report._histogram(devices, images, TARGETS)
+        self.assertEqual(5, report['devices'])
+        self.assertEqual(1, report['not-seen'])
+        rpi = report['hardware-ids']['rpi']
+        self.assertEqual('rpi-2', rpi['latest'])
+        self.assertEqual({'rpi-1': 1, 'rpi-2': 1}, rpi['targets'])
+        self.assertEqual(1, rpi['unknown'])
+        self.assertEqual(2, rpi['outdated'])
+        # imx-1 shares its hash with rpi-1 but must not be confused with it
+        imx = report['hardware-ids']['imx']
+        self.assertEqual({'imx-1': 1}, imx['targets'])
+        self.assertEqual(0, imx['outdated'])
+
+
+class TestImageReport(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeReportDB()
+        patcher = mock.patch('ota_api.image_report.report_db', self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.images = {'a': _image('rpi', 'h1'), 'b': _image('rpi', 'h2')}
+        self.devices = [_device('a'), _device('b')]
+
+    def _report(self, api, max_age=None):
+        return image_report.image_report(
+            api, 'test', lambda: list(self.devices), max_age)
+
+    def test_cached(self):
+        api = FakeAPI(self.images)
+        first = self._report(api)
+        self.assertEqual(first, self._report(api))
+        self.assertEqual(['a', 'b'], api.looked_up)
+        self.assertEqual(['test', 'test'], self.db.locked)
+
+    @mock.patch('ota_api.image_report.time')
+    def test_max_age_clamped(self, time):
+        api = FakeAPI(self.images)
+        time.time.return_value = 1000
+        self._report(api)
+        time.time.return_value = 1000 + image_report.REPORT_MAX_AGE + 1
+        # Asking for an older report than allowed still recomputes it
+        report = self._report(api, max_age=10 ** 6)
+        self.assertEqual(1000 + image_report.REPORT_MAX_AGE + 1,
+                         report['created'])
+
+    def test_max_age_zero(self):
+        api = FakeAPI(self.images)
+        self._report(api)
+        report = self._report(api, max_age=0)
+        self.assertEqual(0, report['refreshed'])
+
+    def test_incremental(self):
+        api = FakeAPI(self.images)
+        self._report(api)
+
+        self.devices = [_device('a'), _device('b', 't1'), _device('c')]
+        self.images['b'] = _image('rpi', 'h1')
+        self.images['c'] = _image('rpi', 'h2')
+        api.looked_up = []
+        report = self._report(api, max_age=0)
+        self.assertEqual(['b', 'c'], api.looked_up)
+        self.assertEqual(2, report['refreshed'])
+        rpi = report['hardware-ids']['rpi']
+        self.assertEqual({'rpi-1': 2, 'rpi-2': 1}, rpi['targets'])
+
+    def test_deleted_devices_dropped(self):
+        api = FakeAPI(self.images)
+        self._report(api)
+        self.devices = [_device('a')]
+        report = self._report(api, max_age=0)
+        self.assertEqual(1, report['devices'])
+        self.assertEqual(['a'], list(self.db.images['test']))
+
+    def test_partial_failure_saved(self):
+        self.devices.append(_device('c'))
+        api = FakeAPI(self.images, fail='c')
+        with self.assertRaises(RuntimeError):
+            self._report(api)
+
+        api = FakeAPI(self.images)
+        self._report(api)
+        self.assertEqual(['c'], api.looked_up)
+
+
+class TestDeviceImages(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.api = OTACommunityEditionAPI('default')
+
+    def test_not_seen_and_deleted(self):
+        def device_image(device):
+            if device['uuid'] == 'gone':
+                raise IndexError()
+            return device['uuid'] + '-image'
+
+        devices = [
+            _device('a'), _device('gone'), _device('new', status='NotSeen')]
+        with self.app.test_request_context(), \
+                mock.patch.object(self.api, 'device_image', device_image):
+            images = dict(self.api.device_images(devices, 2))
+        self.assertEqual({'a': 'a-image', 'gone': None, 'new': None}, images)
+
+    def test_failure_cancels(self):
+        looked_up = []
+
+        def device_image(device):
+            looked_up.append(device['uuid'])
+            raise HTTPException(response=mock.Mock(status_code=500))
+
+        devices = [_device(str(x)) for x in range(50)]
+        with self.app.test_request_context(), \
+                mock.patch.object(self.api, 'device_image', device_image):
+            with self.assertRaises(HTTPException):
+                list(self.api.device_images(devices, 1))
+        self.assertLess(len(looked_up), 50)
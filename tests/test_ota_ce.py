@@ -0,0 +1,218 @@
+# Copyright (C) 2019 Foundries.io
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+from ota_api import ota_ce
+
+URL = 'http://director'
+
+
+class Clock(object):
+    """Stands in for the time module in ota_ce so tests control the clock."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class StubMethod(object):
+    """Stands in for requests.get/put/etc, returning or raising whatever
+       the next item in `results` is after an optional delay. A delay can
+       be a threading.Event to block until the test sets it.
+    """
+    def __init__(self, name, results, delay=0):
+        self.__name__ = name
+        self.results = list(results)
+        self.delay = delay
+        self.timeouts = []
+
+    def __call__(self, url, *args, **kwargs):
+        self.timeouts.append(kwargs['timeout'])
+        result = self.results.pop(0) if len(self.results) > 1 \
+            else self.results[0]
+        delay = result[1] if isinstance(result, tuple) else self.delay
+        if isinstance(result, tuple):
+            result = result[0]
+        if isinstance(delay, threading.Event):
+            delay.wait()
+        else:
+            time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return mock.Mock(status_code=result, json=lambda: {})
+
+
+@mock.patch('ota_api.ota_ce.BREAKER_FAILURES', 3)
+@mock.patch('ota_api.ota_ce.BREAKER_RESET', 0.2)
+@mock.patch('ota_api.ota_ce.UPSTREAM_RETRIES', 1)
+@mock.patch('ota_api.ota_ce.UPSTREAM_TIMEOUT', 10)
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        ota_ce._upstreams.clear()
+        self.app = Flask(__name__)
+        self.server = ota_ce._Server('default', URL)
+        self.upstream = ota_ce._upstream(URL)
+
+    def _request(self, method, deadline=5, **kwargs):
+        with self.app.test_request_context():
+            ota_ce.request_deadline_start()
+            environ = ota_ce.request.environ
+            environ[ota_ce._DEADLINE_KEY] = ota_ce.time.monotonic() + deadline
+            try:
+                return self.server.request(method, '/x', **kwargs)
+            except HTTPException as e:
+                return e.response
+
+    def _stats(self):
+        return self.upstream.stats()
+
+    @mock.patch('ota_api.ota_ce.time', new_callable=Clock)
+    def test_breaker_opens(self, clock):
+        put = StubMethod('put', [500])
+        for _ in range(3):
+            self.assertEqual(500, self._request(put).status_code)
+        self.assertEqual('open', self._stats()['breaker'])
+
+        r = self._request(put)
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(3, len(put.timeouts))
+        self.assertEqual(1, self._stats()['rejected'])
+
+    @mock.patch('ota_api.ota_ce.time', new_callable=Clock)
+    def test_breaker_half_open(self, clock):
+        put = StubMethod('put', [500, 500, 500, 500, 200])
+        for _ in range(3):
+            self._request(put)
+        clock.now += 0.1
+        self.assertEqual('open', self._stats()['breaker'])
+        clock.now += 0.2
+        self.assertEqual('half-open', self._stats()['breaker'])
+
+        # Only a single trial is allowed through
+        self.assertTrue(self.upstream.allow())
+        self.assertFalse(self.upstream.allow())
+        self.upstream.failure()
+        self.assertEqual('open', self._stats()['breaker'])
+
+        clock.now += 0.3
+        self.assertEqual(500, self._request(put).status_code)
+        self.assertEqual('open', self._stats()['breaker'])
+
+        clock.now += 0.3
+        self.assertEqual(200, self._request(put).status_code)
+        self.assertEqual('closed', self._stats()['breaker'])
+
+    def test_deadline_exceeded(self):
+        put = StubMethod('put', [200])
+        self.assertEqual(504, self._request(put, deadline=0).status_code)
+        self.assertEqual([], put.timeouts)
+
+    def test_write_deadline(self):
+        # requests' timeout doesn't bound the whole call, so a write that
+        # keeps trickling data must still be cut off at the deadline
+        hung = threading.Event()
+        self.addCleanup(hung.set)
+        put = StubMethod('put', [(200, hung)])
+        start = time.monotonic()
+        r = self._request(put, deadline=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(504, r.status_code)
+        self.assertEqual(
+            ota_ce._Server.DEADLINE_MESSAGE, r.get_json()['message'])
+
+    def test_timeout_budget(self):
+        put = StubMethod('put', [200])
+        self._request(put, deadline=20)
+        self._request(put, deadline=2)
+        self._request(put, deadline=20, timeout=1)
+        self.assertEqual(10, put.timeouts[0])
+        self.assertLessEqual(put.timeouts[1], 2)
+        self.assertEqual(1, put.timeouts[2])
+
+    def test_cut_short_timeout_not_a_failure(self):
+        get = StubMethod('get', [requests.Timeout()])
+        for _ in range(8):
+            r = self._request(get, 0.1)
+            self.assertEqual(504, r.status_code)
+            self.assertEqual(
+                ota_ce._Server.DEADLINE_MESSAGE, r.get_json()['message'])
+        stats = self._stats()
+        self.assertEqual('closed', stats['breaker'])
+        self.assertEqual(0, stats['failures'])
+
+    def test_full_timeout_is_a_failure(self):
+        put = StubMethod('put', [requests.Timeout()])
+        r = self._request(put, timeout=1)
+        self.assertEqual(504, r.status_code)
+        self.assertEqual(
+            'Upstream timed out after 1s', r.get_json()['message'])
+        self.assertEqual(1, self._stats()['failures'])
+
+    def test_queued_hedge_not_a_failure(self):
+        get = StubMethod('get', [200])
+        call = (get, URL + '/x', time.monotonic() - 1, 10, 'GET /x', (), {})
+        with self.assertRaises(requests.Timeout):
+            self.server._send(call)
+        self.assertEqual([], get.timeouts)
+        self.assertEqual(0, self._stats()['failures'])
+
+    def test_retry(self):
+        get = StubMethod('get', [requests.ConnectionError(), 200])
+        self.assertEqual(200, self._request(get).status_code)
+        stats = self._stats()
+        self.assertEqual(1, stats['retries'])
+        self.assertEqual(0, stats['hedges'])
+
+    def test_retries_exhausted(self):
+        get = StubMethod('get', [requests.ConnectionError()])
+        self.assertEqual(502, self._request(get).status_code)
+        self.assertEqual(2, len(get.timeouts))
+
+    def test_hedge(self):
+        for _ in range(ota_ce._Upstream.MIN_SAMPLES):
+            self.upstream.success('GET /x', 0.01)
+        self.assertEqual(0.01, self.upstream.hedge_delay('GET /x'))
+
+        # The first attempt never answers, so only a hedge can succeed
+        hung = threading.Event()
+        self.addCleanup(hung.set)
+        get = StubMethod('get', [(200, hung), (201, 0)])
+        r = self._request(get, expected=201)
+        self.assertEqual(201, r.status_code)
+        stats = self._stats()
+        self.assertEqual(1, stats['hedges'])
+        self.assertEqual(0, stats['retries'])
+
+    def test_no_hedge_without_history(self):
+        get = StubMethod('get', [(200, 0.2)])
+        self.assertEqual(200, self._request(get).status_code)
+        self.assertEqual(0, self._stats()['hedges'])
+
+    def test_hedge_delay_per_resource(self):
+        for _ in range(ota_ce._Upstream.MIN_SAMPLES):
+            self.upstream.success('GET /a', 0.01)
+        self.assertIsNotNone(self.upstream.hedge_delay('GET /a'))
+        self.assertIsNone(self.upstream.hedge_delay('GET /a?limit&offset'))
+
+    def test_latency_key(self):
+        get = StubMethod('get', [])
+        key = ota_ce._latency_key(
+            get, '/api/v1/devices/8b3f2a1e-0c5d-4e6f-9a7b-1c2d3e4f5a6b/queue',
+            None)
+        self.assertEqual('GET /api/v1/devices/{}/queue', key)
+        params = {'offset': 0, 'limit': 100, 'regex': None}
+        key = ota_ce._latency_key(get, '/api/v1/devices', params)
+        self.assertEqual('GET /api/v1/devices?limit&offset', key)
+
+    def test_stats(self):
+        stats = ota_ce.upstream_stats()
+        self.assertIn('pid', stats)
+        self.assertEqual([URL], [x['url'] for x in stats['upstreams']])